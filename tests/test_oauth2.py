@@ -0,0 +1,216 @@
+"""Tests for the OAuth2 authorization redirect and callback handling."""
+import asyncio
+import json
+from urllib.parse import urlencode, urlsplit, parse_qs
+
+import jwt
+import pytest
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from aiohttp_session import Session, SESSION_KEY
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from w3id.oauth2 import SessionOAuth2Authentication, W3IDClient
+from w3id.oauth2.client import OAuth2Client
+
+
+ENDPOINT = 'https://idp.example.com/authorize'
+
+PARAMS = {
+    'client_id': 'client',
+    'client_secret': 'secret',
+    'authorization_endpoint': ENDPOINT,
+    'token_endpoint': 'https://idp.example.com/token',
+    'redirect_uri': 'https://app.example.com/callback',
+    'scope': 'openid',
+}
+
+TOKEN_DATA = {'access_token': 'a', 'refresh_token': 'r', 'expires_in': 3600}
+
+
+class FakeClient(OAuth2Client):
+    "OAuth2 client that never talks to the network."
+
+    def __init__(self, **params):
+        super().__init__(**params)
+        self.token_requests = 0
+
+    async def get_access_token(self, code):
+        self.token_requests += 1
+        return dict(TOKEN_DATA)
+
+    def user_parse(self, data):
+        return 'user@example.com'
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+def make_request(session, path='/', **query):
+    if query:
+        path += '?' + urlencode(query)
+    request = make_mocked_request('GET', path)
+    request[SESSION_KEY] = session
+    return request
+
+def redirect(policy, session):
+    "Run policy.get() for a request without a ticket and return the redirect query."
+    with pytest.raises(web.HTTPFound) as einfo:
+        run(policy.get(make_request(session)))
+    query = parse_qs(urlsplit(einfo.value.location).query)
+    return query['state'][0], query['nonce'][0]
+
+@pytest.fixture
+def policy():
+    policy = SessionOAuth2Authentication(client=FakeClient(**PARAMS))
+    # Mint a new state on every redirect unless a test asks otherwise
+    policy.state_reuse_interval = 0
+    return policy
+
+@pytest.fixture
+def session():
+    return Session('id', data=None, new=True)
+
+
+def test_authorization_endpoint_without_params():
+    client = FakeClient(**PARAMS)
+    params = {'redirect_uri': PARAMS['redirect_uri'], 'scope': 'openid',
+              'client_id': 'client', 'response_type': 'code'}
+    assert client.get_authorization_endpoint() == ENDPOINT + '?' + urlencode(params)
+
+def test_authorization_endpoint_appends_state_and_nonce():
+    client = FakeClient(**PARAMS)
+    url = client.get_authorization_endpoint(state='s&1', nonce='n 2')
+    assert url == client.get_authorization_endpoint() + '&state=s%261&nonce=n+2'
+
+def test_authorization_endpoint_override_rebuilds():
+    client = FakeClient(**PARAMS)
+    query = parse_qs(urlsplit(client.get_authorization_endpoint(scope='email')).query)
+    assert query['scope'] == ['email']
+    assert query['client_id'] == ['client']
+
+@pytest.mark.parametrize('query', [{'state': 'bogus'}, {}])
+def test_callback_rejects_bad_state(policy, session, query):
+    redirect(policy, session)
+    response = run(policy.auth_callback(make_request(session, code='c', **query)))
+    assert isinstance(response, web.HTTPForbidden)
+    assert policy.client.token_requests == 0
+
+def test_callback_rejects_replayed_state(policy, session):
+    state, _ = redirect(policy, session)
+    response = run(policy.auth_callback(make_request(session, code='c', state=state)))
+    assert isinstance(response, web.HTTPFound)
+
+    response = run(policy.auth_callback(make_request(session, code='c', state=state)))
+    assert isinstance(response, web.HTTPForbidden)
+    assert policy.client.token_requests == 1
+
+def test_callback_accepts_any_pending_state(policy, session):
+    first, _ = redirect(policy, session)
+    redirect(policy, session)
+    response = run(policy.auth_callback(make_request(session, code='c', state=first)))
+    assert isinstance(response, web.HTTPFound)
+
+@pytest.mark.parametrize('value', ['{"state": "s", "nonce": "n"}', '[["s"]]',
+                                   '[[1, 2, 3]]', '["s", "n", 0]', 'not json'])
+def test_malformed_pending_states(policy, session, value):
+    session[policy.state_name] = value
+    policy.state_reuse_interval = 5
+    state, _ = redirect(policy, session)
+    response = run(policy.auth_callback(make_request(session, code='c', state='s')))
+    assert isinstance(response, web.HTTPForbidden)
+    response = run(policy.auth_callback(make_request(session, code='c', state=state)))
+    assert isinstance(response, web.HTTPFound)
+
+def test_concurrent_redirects_share_state(policy, session):
+    policy.state_reuse_interval = 5
+    assert redirect(policy, session) == redirect(policy, session)
+    assert json.loads(session[policy.redirects_name])[1] == 1
+
+def test_redirect_limit(policy, session):
+    for _ in range(policy.max_redirects):
+        redirect(policy, session)
+    with pytest.raises(web.HTTPTooManyRequests):
+        run(policy.get(make_request(session)))
+
+    # Move the window into the past
+    since, count = json.loads(session[policy.redirects_name])
+    since -= policy.redirect_window + 1
+    session[policy.redirects_name] = json.dumps([since, count])
+    redirect(policy, session)
+
+def test_redirect_limit_survives_successful_callbacks(policy, session):
+    # The IdP logs the user in silently, but the ticket keeps getting lost
+    for _ in range(policy.max_redirects):
+        state, _ = redirect(policy, session)
+        run(policy.auth_callback(make_request(session, code='c', state=state)))
+        del session[policy.cookie_name]
+    with pytest.raises(web.HTTPTooManyRequests):
+        run(policy.get(make_request(session)))
+
+def test_valid_ticket_resets_redirect_counter(policy, session):
+    state, _ = redirect(policy, session)
+    run(policy.auth_callback(make_request(session, code='c', state=state)))
+    assert run(policy.get(make_request(session))) == 'user@example.com'
+    assert policy.redirects_name not in session
+
+
+def make_w3id_client(nonce):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                   backend=default_backend())
+    client = W3IDClient(certificate=None, **PARAMS)
+    client.public_key = key.public_key()
+    id_token = jwt.encode({'aud': 'client', 'emailAddress': 'user@example.com',
+                           'nonce': nonce}, key, algorithm='RS256')
+    return client, {'id_token': id_token}
+
+def test_w3id_nonce_mismatch():
+    client, data = make_w3id_client('other')
+    with pytest.raises(web.HTTPNetworkAuthenticationRequired):
+        client.verify_nonce(data, 'nonce')
+
+def test_w3id_non_ascii_nonce():
+    client, data = make_w3id_client('nönce')
+    with pytest.raises(web.HTTPNetworkAuthenticationRequired):
+        client.verify_nonce(data, 'nonce')
+
+def test_w3id_nonce_match():
+    client, data = make_w3id_client('nonce')
+    client.verify_nonce(data, 'nonce')
+    assert client.user_parse(data) == 'user@example.com'
+
+def test_callback_rejects_nonce_mismatch(policy, session):
+    redirect(policy, session)
+    client, data = make_w3id_client('other')
+    policy.client = client
+    state = json.loads(session[policy.state_name])[-1][0]
+
+    async def get_access_token(code):
+        return dict(TOKEN_DATA, **data)
+    client.get_access_token = get_access_token
+
+    with pytest.raises(web.HTTPNetworkAuthenticationRequired):
+        run(policy.auth_callback(make_request(session, code='c', state=state)))
+    assert policy.cookie_name not in session
+
+def test_callback_decodes_id_token_once(policy, session, monkeypatch):
+    state, nonce = redirect(policy, session)
+    client, data = make_w3id_client(nonce)
+    policy.client = client
+
+    async def get_access_token(code):
+        return dict(TOKEN_DATA, **data)
+    client.get_access_token = get_access_token
+
+    calls = []
+    decode = jwt.decode
+    def counting_decode(*args, **kwargs):
+        calls.append(args)
+        return decode(*args, **kwargs)
+    monkeypatch.setattr(jwt, 'decode', counting_decode)
+
+    response = run(policy.auth_callback(make_request(session, code='c', state=state)))
+    assert isinstance(response, web.HTTPFound)
+    assert len(calls) == 1
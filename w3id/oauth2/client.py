@@ -66,8 +66,28 @@ class OAuth2Client(Client):
         self.client_secret = client_secret
         self.params = params
 
+        # The static part of the authorize URL is encoded once; see
+        # get_authorization_endpoint()
+        static_params = dict(self.params)
+        static_params.update({'client_id': self.client_id, 'response_type': self.shared_key})
+        self._authorization_url = self.authorization_endpoint + '?' + urlencode(static_params)
+        self._static_keys = frozenset(static_params)
+
     def get_authorization_endpoint(self, **params):
-        """Return formatted authorize URL."""
+        """Return formatted authorize URL.
+
+        The static part of the URL is built from `params`, `client_id`,
+        `authorization_endpoint` and `shared_key` in `__init__`, so changes
+        to these attributes after construction are not picked up.
+        """
+        if not params:
+            return self._authorization_url
+
+        if self._static_keys.isdisjoint(params):
+            # Per-request parameters (e.g. state, nonce) are simply appended
+            return self._authorization_url + '&' + urlencode(params)
+
+        # Overriding static parameters requires a full rebuild
         params = dict(self.params, **params)
         params.update({'client_id': self.client_id, 'response_type': self.shared_key})
         return self.authorization_endpoint + '?' + urlencode(params)
@@ -141,6 +161,14 @@ class OAuth2Client(Client):
 
         return await self._token_endpoint_request(form_data, 'refresh_token', refresh_token)
 
+    def verify_nonce(self, data, nonce):
+        """Verify that the provider `data` was issued for `nonce`.
+
+        Plain OAuth2 has no id_token to carry the nonce, so this is a no-op;
+        OpenID Connect clients should override it.
+        """
+        pass
+
     @abc.abstractmethod
     def user_parse(self, data):
         """Parse information from provider."""
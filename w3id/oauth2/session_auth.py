@@ -14,7 +14,9 @@
 
 """Implement authentification policy via oauth2 and store the result in a session."""
 import json
+import secrets
 
+from hmac import compare_digest
 from datetime import datetime
 import dateutil.parser
 
@@ -28,10 +30,88 @@ class SessionOAuth2Authentication(AbstractOAuth2Policy):
     ticket data being stored in a session.
     """
 
-    def __init__(self, client, cookie_name='OAUTH2_OID'):
+    # Number of pending authorization requests remembered per session
+    max_pending_states = 4
+
+    # Requests arriving within this many seconds of the last authorization
+    # redirect (e.g. a page and its XHRs) reuse its state instead of minting
+    # a new one and counting against `max_redirects`
+    state_reuse_interval = 5
+
+    def __init__(self, client, cookie_name='OAUTH2_OID',
+                 max_redirects=5, redirect_window=60):
         self.client = client
         self.cookie_name = cookie_name
 
+        # Session keys for the pending authorization requests and redirect counter
+        self.state_name = cookie_name + '_STATE'
+        self.redirects_name = cookie_name + '_REDIRECTS'
+
+        # Allow at most `max_redirects` authorization redirects per client
+        # within `redirect_window` seconds to break redirect loops
+        self.max_redirects = max_redirects
+        self.redirect_window = redirect_window
+
+    def _load_pending(self, session):
+        "Returns the list of pending [state, nonce, creation_time] entries, oldest first."
+        try:
+            pending = json.loads(session[self.state_name])
+        except (KeyError, TypeError, ValueError):
+            return []
+
+        # Skip stale or tampered entries rather than failing every request
+        if not isinstance(pending, list):
+            return []
+        return [entry for entry in pending
+                if isinstance(entry, list) and len(entry) == 3
+                and isinstance(entry[0], str) and isinstance(entry[1], str)
+                and isinstance(entry[2], (int, float)) and not isinstance(entry[2], bool)]
+
+    async def _authorization_redirect(self, request):
+        session = await get_session(request)
+        pending = self._load_pending(session)
+        now = datetime.now().timestamp()
+
+        # Concurrent requests share a recent pending state, so that they neither
+        # invalidate each other nor burn through the redirect budget
+        if pending and now - pending[-1][2] < self.state_reuse_interval:
+            state, nonce, _ = pending[-1]
+            return web.HTTPFound(self.client.get_authorization_endpoint(state=state, nonce=nonce))
+
+        # Count redirects to the authorization page and refuse to loop forever
+        try:
+            since, count = json.loads(session[self.redirects_name])
+            if now - since > self.redirect_window:
+                since, count = now, 0
+        except (KeyError, TypeError, ValueError):
+            since, count = now, 0
+
+        if count >= self.max_redirects:
+            raise web.HTTPTooManyRequests(reason='Too many OAuth2 authorization redirects.')
+        session[self.redirects_name] = json.dumps([since, count + 1])
+
+        # Remember the state and nonce so that the callback can be verified locally
+        state = secrets.token_urlsafe(16)
+        nonce = secrets.token_urlsafe(16)
+        pending.append([state, nonce, now])
+        session[self.state_name] = json.dumps(pending[-self.max_pending_states:])
+
+        return web.HTTPFound(self.client.get_authorization_endpoint(state=state, nonce=nonce))
+
+    def _pop_pending(self, session, state):
+        "Removes the pending entry for `state` and returns its nonce, or None if unknown."
+        state = state.encode()
+        pending = self._load_pending(session)
+        for i, entry in enumerate(pending):
+            if compare_digest(state, entry[0].encode()):
+                del pending[i]
+                if pending:
+                    session[self.state_name] = json.dumps(pending)
+                else:
+                    del session[self.state_name]
+                return entry[1]
+        return None
+
     async def _make_cookie(self, request, user_id, data):
         expires_in = int(data['expires_in'])
 
@@ -88,9 +168,13 @@ class SessionOAuth2Authentication(AbstractOAuth2Policy):
                 # Get the refresh if possible and update the cookie
                 data = await self.client.refresh_access_token(fields)
                 await self._make_cookie(request, user_id, data)
+
+            # The ticket is valid, so we are not in a redirect loop
+            if self.redirects_name in session:
+                del session[self.redirects_name]
         except:
             # Redirect to the login page
-            raise web.HTTPFound(self.client.get_authorization_endpoint())
+            raise await self._authorization_redirect(request)
 
         return user_id
 
@@ -105,11 +189,19 @@ class SessionOAuth2Authentication(AbstractOAuth2Policy):
         # If we got the code, then query the access token
         code = request.query.get(self.client.shared_key, None)
         if code:
+            # Drop bogus or replayed callbacks before they reach the token endpoint;
+            # the pending state is single use.
+            session = await get_session(request)
+            nonce = self._pop_pending(session, request.query.get('state', ''))
+            if nonce is None:
+                return web.HTTPForbidden(reason='Invalid OAuth2 state.')
+
             # Turn a code into an OAuth2 access token
             data = await self.client.get_access_token(code)
 
             # Verify that we have received the token
             try:
+                self.client.verify_nonce(data, nonce)
                 user_id = self.client.user_parse(data)
                 await self._make_cookie(request, user_id, data)
                 return web.HTTPFound('/')
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 """Implement a certificate verifying secure IBM w3id client."""
+from hmac import compare_digest
+
 import jwt
 
 from jwt.exceptions import InvalidTokenError, InvalidKeyError
@@ -24,6 +26,10 @@ from aiohttp import web
 
 from .client import OAuth2Client
 
+# Key under which the decoded id_token is cached in the provider data.
+# JSON can only produce string keys, so the provider cannot forge it.
+_PAYLOAD_KEY = object()
+
 class W3IDClient(OAuth2Client):
     "Implement w3id OAuth2 client for IBM w3id service."
 
@@ -36,8 +42,11 @@ class W3IDClient(OAuth2Client):
                 cert_obj = load_pem_x509_certificate(cert_file.read(), default_backend())
                 self.public_key = cert_obj.public_key()
 
-    def user_parse(self, data):
-        """Parse information from provider."""
+    def _decode_id_token(self, data):
+        payload = data.get(_PAYLOAD_KEY)
+        if payload is not None:
+            return payload
+
         id_token = data['id_token']
 
         try:
@@ -46,7 +55,20 @@ class W3IDClient(OAuth2Client):
                                  audience=self.client_id,
                                  verify=bool(self.public_key),
                                  algorithms=['RS256'])
-
-            return payload['emailAddress']
         except (InvalidTokenError, InvalidKeyError) as einfo:
             raise web.HTTPNetworkAuthenticationRequired(reason=str(einfo))
+
+        # Decode and verify the signature only once per login
+        data[_PAYLOAD_KEY] = payload
+        return payload
+
+    def user_parse(self, data):
+        """Parse information from provider."""
+        return self._decode_id_token(data)['emailAddress']
+
+    def verify_nonce(self, data, nonce):
+        """Verify that the nonce claim of the id_token matches `nonce`."""
+        payload = self._decode_id_token(data)
+        claim = str(payload.get('nonce', '')).encode()
+        if not compare_digest(claim, nonce.encode()):
+            raise web.HTTPNetworkAuthenticationRequired(reason='OAuth2 nonce mismatch.')